@@ -1,14 +1,23 @@
+import asyncio
 import datetime as dt
 import random
 import signal
 import time
 
-from psycopg.rows import dict_row
 from psycopg import Cursor
+from psycopg.rows import class_row
 from viaa.configuration import ConfigParser
 from viaa.observability import logging
 from svix.exceptions import HttpError, HTTPValidationError
-from .services.db import DbClient
+from svix.models import MessageOut
+from .services.db import (
+    DbClient,
+    FetchError,
+    EventRow,
+    BATCH_LIMIT,
+    MAX_ATTEMPTS,
+    MAX_ERROR_LENGTH,
+)
 from .services.svix import SvixClient
 from .helpers.svix_router import SvixRouter
 
@@ -17,6 +26,17 @@ BACKOFF_CAP_S = 900
 
 SLEEP: int = 120
 
+# Bounds of the adaptive batch limit
+BATCH_LIMIT_MIN = 10
+BATCH_LIMIT_MAX = 1000
+# Target duration of handling a batch, in seconds
+BATCH_SLA_S = 10
+# Ratio of failed deliveries in a batch above which the batch limit is lowered
+MAX_ERROR_RATE = 0.1
+# Amount of failed attempts to write the status updates of a batch together
+# with the next fetch, before writing them one status at a time
+MAX_WRITE_ATTEMPTS = 3
+
 
 class PgEventsPoller:
     def __init__(self):
@@ -30,125 +50,308 @@ class PgEventsPoller:
             db_config["dbname"],
             db_config["username"],
             db_config["password"],
+            str(db_config.get("single_worker", "false")).lower() == "true",
         )
         self.svix_client = SvixClient(
             self.config["svix"]["auth_token"], self.config["svix"]["base_url"]
         )
         self.svix_router = SvixRouter(self.config["svix"]["bucket_application_map"])
+        # Bound lookup of the routing map, used for every event of a batch
+        self._route = self.svix_router.map.get
         self.should_continue = True
 
+        # Status updates of the handled batch, written together with the
+        # fetch of the next batch
+        self._updates: dict[str, list] = {}
+        self._reset_batch()
+        # Consecutive failed attempts to write the status updates
+        self._failed_writes = 0
+        self._batch_limit = BATCH_LIMIT
+        # Time the results of the current batch came in
+        self._batch_now = dt.datetime.now(dt.UTC)
+        # Handlers of the errors when delivering an event, by exception type
+        self._err_handlers = {
+            HTTPValidationError: self._on_validation_error,
+            HttpError: self._on_http_error,
+            BaseException: self._on_error,
+        }
+        # Event loop in which all the events are posted to Svix
+        self._runner = asyncio.Runner()
+
     def stop(self, *_) -> None:
         self.should_continue = False
 
     def _backoff_seconds(self, attempts: int) -> int:
         """Calculate the backoff to retry a failed attempt to send to Svix.
 
+        The backoff grows exponentially up to `BACKOFF_CAP_S`, with full jitter
+        to spread the retries.
+
         Args:
             attempts: The amount of attempts of sending an event to Svix.
 
         Returns:
             Time to wait to try again, in seconds.
         """
-        base = min(BACKOFF_CAP_S, 2 ** max(0, attempts))
-        return max(1, int(base * random.uniform(0.8, 1.2)))
+        base = min(BACKOFF_CAP_S, 1 << min(max(0, attempts), 10))
+        return random.randint(1, base)
 
     def calculate_next_timestamp_to_retry(self, attempts: int) -> dt.datetime:
-        return dt.datetime.now(dt.UTC) + dt.timedelta(
+        """Calculate when to retry a failed attempt, relative to the time the
+        results of the batch came in.
+        """
+        return self._batch_now + dt.timedelta(
             seconds=self._backoff_seconds(attempts)
         )
 
-    def _handle_webhook_event(self, cur: Cursor, row: dict[str, str]):
-        """Handle a webhook event record.
-
-        This event will be sent to the Svix server.
+    def _retry_webhook_event(
+        self, row_id: int, attempts: int, err: str, next_at: dt.datetime
+    ) -> None:
+        """Schedule a retry of the event, or mark it as dead when it reached
+        the maximum amount of attempts.
         """
-        row_id: int = int(row["id"])
-        attempts: int = int(row["attempts"])
-        event_type = row["event_type"]
-        s3_bucket = row["s3_bucket"]
-        payload: dict[str, str] = row["payload"]
-
-        # Check mapping to Svix application
-        app_id = self.svix_router.route(s3_bucket)
-        if not app_id:
-            self.db_client.mark_skipped(
-                cur,
-                row_id,
-            )
-            self.log.debug(
-                "Unknown bucket, cannot be routed to an application in Svix",
-                id=row_id,
-            )
-            return
+        if attempts >= MAX_ATTEMPTS:
+            self._updates["dead"].append((row_id, attempts, err))
+        else:
+            self._updates["retry"].append((row_id, attempts, err, next_at))
 
-        try:
-            response = self.svix_client.post_event(app_id, row_id, event_type, payload)
-        except HTTPValidationError as http_val_e:
-            # This mean invalid body, no reason to retry
-            status_code = http_val_e.status_code
-            self.db_client.mark_dead(
-                cur,
-                row_id,
-                attempts + 1,
-                repr(http_val_e),
-            )
-            self.log.error(
-                "Validation error when delivering event",
-                id=row_id,
-                status_code=status_code,
-                error=repr(http_val_e)
-            )
+    def _on_validation_error(self, row: EventRow, e: HTTPValidationError) -> None:
+        # This mean invalid body, no reason to retry
+        err = repr(e)[:MAX_ERROR_LENGTH]
+        self._updates["dead"].append((row.id, row.attempts + 1, err))
+        self.log.error(
+            "Validation error when delivering event",
+            id=row.id,
+            status_code=e.status_code,
+            error=err
+        )
+
+    def _on_http_error(self, row: EventRow, e: HttpError) -> None:
+        if e.status_code == 401:
+            self._on_unauthorized(row)
             return
-        except HttpError as http_e:
-            status_code = http_e.status_code
-            if status_code == 401:
-                self.stop()
-                self.db_client.mark_pending(
-                    cur,
-                    row_id,
+
+        err = repr(e)[:MAX_ERROR_LENGTH]
+        next_at = self.calculate_next_timestamp_to_retry(row.attempts)
+        self._retry_webhook_event(row.id, row.attempts + 1, err, next_at)
+        self.log.error(
+            "Error when delivering event",
+            id=row.id,
+            status_code=e.status_code,
+            error=err
+        )
+
+    def _on_unauthorized(self, row: EventRow) -> None:
+        # No event can be delivered anymore, release the event and stop polling
+        self.stop()
+        self._updates["pending"].append(row.id)
+        self.log.error(
+            "Invalid auth header",
+        )
+
+    def _on_error(self, row: EventRow, e: BaseException) -> None:
+        err = repr(e)[:MAX_ERROR_LENGTH]
+        next_at = self.calculate_next_timestamp_to_retry(row.attempts)
+        self._retry_webhook_event(row.id, row.attempts + 1, err, next_at)
+        self.log.error("Something went wrong", error=err)
+
+    def _handle_webhook_event(
+        self, row: EventRow, result: MessageOut | BaseException
+    ):
+        """Handle the result of sending a webhook event record to the Svix server.
+
+        The resulting status update is queued until the batch is flushed.
+        Errors are handled by the handler of the most specific type in
+        `_err_handlers`.
+
+        Args:
+            row: The webhook event record.
+            result: The response message from Svix, or the exception raised
+                while sending the event.
+        """
+        if isinstance(result, BaseException):
+            for cls in type(result).__mro__:
+                if (handler := self._err_handlers.get(cls)) is not None:
+                    handler(row, result)
+                    return
+
+        self._updates["sent"].append((row.id, result.id))
+        self.log.debug(
+            "Event delivered",
+            id=row.id,
+        )
+
+    def _adapt_batch_limit(self, row_count: int, elapsed: float, failures: int) -> None:
+        """Adapt the amount of records to fetch based on the last batch.
+
+        A full batch that was handled well within `BATCH_SLA_S` means there is
+        a backlog, so the limit is doubled. If too many deliveries failed, the
+        limit is halved to go easy on Svix.
+
+        Args:
+            row_count: The amount of records in the batch.
+            elapsed: The time it took to handle the batch, in seconds.
+            failures: The amount of failed deliveries in the batch.
+        """
+        if failures > MAX_ERROR_RATE * row_count:
+            self._batch_limit = max(BATCH_LIMIT_MIN, self._batch_limit // 2)
+        elif row_count >= self._batch_limit and elapsed < BATCH_SLA_S / 2:
+            self._batch_limit = min(BATCH_LIMIT_MAX, self._batch_limit * 2)
+
+    def _reset_batch(self) -> None:
+        """Drop the queued status updates of the batch."""
+        self._updates = {
+            "skipped": [],
+            "sent": [],
+            "retry": [],
+            "dead": [],
+            "pending": [],
+        }
+
+    def _handle_batch(self, rows: list[EventRow]) -> None:
+        """Send a batch of webhook event records to the Svix server.
+
+        Records which cannot be routed to a Svix application are skipped. The
+        others are sent concurrently and their status is updated once all the
+        results are in. The status updates are queued, to be written by the
+        next fetch.
+        """
+        routable: list[tuple[str, EventRow]] = []
+        for row in rows:
+            # Check mapping to Svix application
+            app_id = self._route(row.s3_bucket)
+            if app_id is None:
+                self._updates["skipped"].append(row.id)
+                self.log.debug(
+                    "Unknown bucket, cannot be routed to an application in Svix",
+                    id=row.id,
                 )
+                continue
+            routable.append((app_id, row))
+
+        results = self._runner.run(
+            self.svix_client.post_events_batch(
+                [
+                    (app_id, row.id, row.event_type, row.payload)
+                    for app_id, row in routable
+                ]
+            )
+        )
+
+        self._batch_now = dt.datetime.now(dt.UTC)
+        for (_, row), result in zip(routable, results):
+            try:
+                self._handle_webhook_event(row, result)
+            except Exception as e:
+                # Release the event, so it is not left behind in the `sending` state
                 self.log.error(
-                    "Invalid auth header",
+                    "Error when handling the result of event",
+                    id=row.id,
+                    error=repr(e),
                 )
-                return
-
-            next_at = self.calculate_next_timestamp_to_retry(attempts)
-            self.db_client.mark_retry(
-                cur,
-                row_id,
-                attempts + 1,
-                repr(http_e),
-                next_at,
+                self._updates["pending"].append(row.id)
+
+        if delivered := self._updates["sent"]:
+            self.log.info(
+                "Batch delivered",
+                count=len(delivered),
+                first_id=delivered[0][0],
+                last_id=delivered[-1][0],
             )
-            self.log.error(
-                "Error when delivering event",
-                id=row_id,
-                status_code=status_code,
-                error=repr(http_e)
+
+    def _write_updates_separately(self) -> None:
+        """Write the queued status updates one status at a time.
+
+        Used when writing them together with the next fetch keeps failing. The
+        updates of a status that fail are dropped, so they cannot block the
+        polling. Their records have been rolled back to pending and will be
+        delivered again.
+        """
+        for status, rows in self._updates.items():
+            if not rows:
+                continue
+            try:
+                with self.db_client.pool.connection() as conn:
+                    with conn.cursor() as cur:
+                        self.db_client.commit_batch(cur, {status: rows})
+            except Exception as e:
+                self.log.error(
+                    "Dropped status updates",
+                    status=status,
+                    count=len(rows),
+                    error=repr(e),
+                )
+        self._updates_written()
+
+    def _fetch(self, cur: Cursor) -> list[EventRow]:
+        """Write the status updates of the handled batch and fetch the next one.
+
+        A failure is counted as a failed write of the status updates, see
+        `MAX_WRITE_ATTEMPTS`. The updates are kept to be written again, unless
+        only the fetch failed.
+        """
+        try:
+            rows = self.db_client.fetch_and_finalize(
+                cur, self._updates, self._batch_limit
             )
-            return
-        except Exception as e:
-            next_at = self.calculate_next_timestamp_to_retry(attempts)
-            self.db_client.mark_retry(
-                cur,
-                row_id,
-                attempts + 1,
-                repr(e),
-                next_at,
+        except FetchError:
+            self._updates_written()
+            raise
+        except Exception:
+            self._failed_writes += 1
+            raise
+        self._updates_written()
+        return rows
+
+    def _commit(self, cur: Cursor) -> None:
+        """Write the status updates of the handled batch and commit it.
+
+        Failures are counted like in `_fetch`.
+        """
+        try:
+            self.db_client.commit_batch(cur, self._updates)
+        except Exception:
+            self._failed_writes += 1
+            raise
+        self._updates_written()
+
+    def _updates_written(self) -> None:
+        """Drop the status updates once they are committed."""
+        self._reset_batch()
+        self._failed_writes = 0
+
+    def _poll(self, cur: Cursor) -> None:
+        """Poll for batches on a single connection until stopped.
+
+        A batch stays in an open transaction while it is delivered, and is
+        committed with its status updates by the next fetch. If anything fails
+        in between, the transaction is rolled back and the batch gets fetched
+        again.
+        """
+        while self.should_continue:
+            rows = self._fetch(cur)
+            if not rows:
+                # Close the transaction of the empty fetch before waiting
+                self.db_client.commit_batch(cur, {})
+                # Wait for new events, or poll again after some time
+                self.db_client.wait_for_events(SLEEP)
+                continue
+
+            start = time.monotonic()
+            self._handle_batch(rows)
+            failures = sum(
+                len(self._updates[status]) for status in ("retry", "dead", "pending")
             )
-            self.log.error("Something went wrong", error=repr(e))
-            return
+            self._adapt_batch_limit(len(rows), time.monotonic() - start, failures)
 
-        self.db_client.mark_sent(cur, row_id, response.id)
-        self.log.info(
-            "Event delivered",
-            id=row_id,
-        )
+        # Write the status updates of the last handled batch
+        self._commit(cur)
 
     def start_polling(self) -> None:
         """The main polling loop.
 
-        Fetch a fixed amount of records that should be processed.
+        Fetch batches of records that should be processed. The size of the
+        batches adapts to the backlog, see `_adapt_batch_limit`.
         """
         # Graceful shutdown signals
         signal.signal(signal.SIGTERM, self.stop)
@@ -159,19 +362,23 @@ class PgEventsPoller:
         while self.should_continue:
             try:
                 with self.db_client.pool.connection() as conn:
-                    with conn.cursor(row_factory=dict_row) as cur:
-                        rows = self.db_client.fetch_batch(cur)
-                        if not rows:
-                            conn.rollback()  # Clear the open (UPDATE … RETURNING) transaction
-                            time.sleep(SLEEP)  # Sleep some time
-                            continue
-
-                        for row in rows:
-                            self._handle_webhook_event(cur, row)
-                        conn.commit()
+                    with conn.cursor(
+                        row_factory=class_row(EventRow), binary=True
+                    ) as cur:
+                        self._poll(cur)
 
             except Exception as e:
                 self.log.error("Error during executing polling loop", error=repr(e))
+                # Only failures to write the updates count, not e.g. a timeout
+                # to get a connection while Postgres is down
+                if self._failed_writes >= MAX_WRITE_ATTEMPTS:
+                    self._write_updates_separately()
                 time.sleep(1)
 
+        # The last status updates could not be written with the batch
+        if any(self._updates.values()):
+            self._write_updates_separately()
+        self.db_client.close_listen_conn()
+        self._runner.close()
+
         self.log.info("Poller stopped gracefully")
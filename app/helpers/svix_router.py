@@ -32,6 +32,15 @@ class SvixRouter:
                 f"Invalid mapping of buckets to Svix applications: {e}"
             ) from e
 
+        if not isinstance(self.map, dict) or not all(
+            isinstance(bucket, str) and isinstance(app_id, str) and app_id
+            for bucket, app_id in self.map.items()
+        ):
+            raise ValueError(
+                "Invalid mapping of buckets to Svix applications: "
+                "expected an object of bucket names to non-empty application IDs"
+            )
+
     def route(self, s3_bucket: str) -> str | None:
         """Return the Svix application ID for the given S3 bucket.
 
@@ -42,8 +51,4 @@ class SvixRouter:
             str : The Svix application ID associated with the bucket,
             None: if the bucket is not found in the mapping.
         """
-        app_id = self.map.get(s3_bucket)
-        if not app_id:
-            return None
-
-        return app_id
+        return self.map.get(s3_bucket)
@@ -1,8 +1,13 @@
 import datetime as dt
-from typing import Any
+import time
+from typing import NamedTuple
 
+import psycopg
 from psycopg_pool import ConnectionPool
-from psycopg import Cursor
+from psycopg import Connection, Cursor, sql
+from psycopg.abc import Buffer
+from psycopg.adapt import Loader
+from psycopg.pq import Format, TransactionStatus
 from viaa.configuration import ConfigParser
 from viaa.observability import logging
 
@@ -28,86 +33,359 @@ RETURNING
   w.s3_bucket;
 """
 
+# Variant of `FETCH_SQL` without row locks, for when a single poller runs
+# against the database. Pollers can still overlap, e.g. the old and new pod
+# during a rolling update. An event picked by both is then updated by one, while
+# the other waits for that batch to commit. Only the conditions of the outer
+# WHERE are re-evaluated on the committed row, so they repeat the `status` and
+# `next_attempt_at` checks. The waiting poller gets the event only if it was
+# released as pending and due again, not while it is delivered or backing off.
+FETCH_SQL_SINGLE_WORKER = """
+UPDATE webhook_events w
+SET status = 'sending'
+FROM (
+  SELECT id
+  FROM webhook_events
+  WHERE status = 'pending'
+    AND next_attempt_at <= now()
+  ORDER BY id
+  LIMIT %s
+) p
+WHERE w.id = p.id
+  AND w.status = 'pending'
+  AND w.next_attempt_at <= now()
+RETURNING
+  w.id,
+  w.event_type,
+  w.payload,
+  w.attempts,
+  w.s3_bucket;
+"""
+
+
+class EventRow(NamedTuple):
+    """A webhook event record, as returned by `FETCH_SQL`."""
+
+    id: int
+    event_type: str
+    payload: str
+    attempts: int
+    s3_bucket: str
+
+
 MAX_ATTEMPTS = 20
+# Maximum length of the error stored with an event, callers truncate it
+MAX_ERROR_LENGTH = 1000
 BATCH_LIMIT = 100
 
+# Channel on which the producers notify new webhook events
+LISTEN_CHANNEL = "webhook_events_new"
+
+
+class RawJsonbLoader(Loader):
+    """Load a jsonb value as its JSON text, without parsing it."""
+
+    def load(self, data: Buffer) -> str:
+        return bytes(data).decode()
+
+
+class RawJsonbBinaryLoader(Loader):
+    """Load a binary jsonb value as its JSON text, without parsing it."""
+
+    format = Format.BINARY
+
+    def load(self, data: Buffer) -> str:
+        # Skip the jsonb format version byte
+        return bytes(data[1:]).decode()
+
+
+def _configure(conn: Connection) -> None:
+    """Configure a new connection of the pool.
+
+    The payload of the events is posted to Svix as is, so there is no need
+    to parse it into Python objects.
+    """
+    conn.adapters.register_loader("jsonb", RawJsonbLoader)
+    conn.adapters.register_loader("jsonb", RawJsonbBinaryLoader)
+
+
+class FetchError(Exception):
+    """The fetch of a batch failed, after the status updates of the previous
+    batch were committed.
+    """
+
+
+def _in_transaction(cur: Cursor) -> bool:
+    """Whether a transaction is open on the connection of the cursor."""
+    return cur.connection.info.transaction_status != TransactionStatus.IDLE
+
+
+def _columns(rows: list[tuple]) -> list[list]:
+    """Transpose rows into one list per column, to be bound as arrays."""
+    return [list(column) for column in zip(*rows)]
+
 
 class DbClient:
     def __init__(
-        self, host: str, port: int, db_name: str, username: str, password: str
+        self,
+        host: str,
+        port: int,
+        db_name: str,
+        username: str,
+        password: str,
+        single_worker: bool = False,
     ):
+        """Initialize the DbClient.
+
+        Args:
+            single_worker: Whether this is the only poller running against the
+                database. If so, events are fetched without locking them.
+                Overlapping pollers, like during a rolling update, then wait
+                on each other's batches, but never fetch an event that the
+                other one is delivering or that is not due yet.
+        """
         config_parser = ConfigParser()
         self.log = logging.get_logger(__name__, config=config_parser)
+        self.conninfo = (
+            f"host={host} port={str(port)} dbname={db_name} user={username} password={password} "
+            # Detect dead connections within a minute instead of hanging on them
+            "keepalives=1 keepalives_idle=30 keepalives_interval=10 keepalives_count=3 "
+            "tcp_user_timeout=30000 "
+            # Don't wait for the WAL flush on commit. A commit lost in a crash
+            # rolls its batch back to pending, and the redelivery is deduplicated
+            # by the idempotency key.
+            "options='-c synchronous_commit=off'"
+        )
         self.pool = ConnectionPool(
-            f"host={host} port={str(port)} dbname={db_name} user={username} password={password}"
+            self.conninfo,
+            min_size=2,
+            max_size=8,
+            max_idle=300,
+            timeout=5,
+            configure=_configure,
+            # Transactions are managed explicitly, see `fetch_and_finalize`
+            kwargs={"autocommit": True},
         )
+        self.fetch_sql = FETCH_SQL_SINGLE_WORKER if single_worker else FETCH_SQL
+        # Dedicated connection that listens to `LISTEN_CHANNEL`
+        self.listen_conn: Connection | None = None
+
+    def wait_for_events(self, timeout: float) -> None:
+        """Wait until a new event is notified on `LISTEN_CHANNEL`.
+
+        Return when a notification arrives or after `timeout` seconds, whichever
+        comes first. The timeout acts as a fallback for missed notifications
+        and for events that are due for a retry.
 
-    def fetch_batch(self, cur: Cursor) -> list[dict[str, Any]]:
-        """Fetch records to process.
+        The listening connection is opened on the first call, and reopened
+        after it broke. In that case this returns immediately, so events
+        inserted before listening are picked up by the next fetch.
 
-        The open cursor has a dict_row as row_factory.
+        Args:
+            timeout: The maximum time to wait, in seconds.
         """
-        cur.execute(FETCH_SQL, (BATCH_LIMIT,))
+        if self.listen_conn is None or self.listen_conn.closed:
+            try:
+                self.listen_conn = psycopg.connect(self.conninfo, autocommit=True)
+                self.listen_conn.execute(
+                    sql.SQL("LISTEN {}").format(sql.Identifier(LISTEN_CHANNEL))
+                )
+            except psycopg.Error as e:
+                self.log.warning("Could not listen for new events", error=repr(e))
+                self.close_listen_conn()
+                time.sleep(timeout)
+            return
+
+        try:
+            for _ in self.listen_conn.notifies(timeout=timeout, stop_after=1):
+                pass
+            # Drain the notifications received in the meantime, a single
+            # fetch picks up all the new events.
+            for _ in self.listen_conn.notifies(timeout=0):
+                pass
+        except psycopg.Error as e:
+            self.log.warning("Error when waiting for new events", error=repr(e))
+            self.close_listen_conn()
+
+    def close_listen_conn(self) -> None:
+        """Close the connection listening for new events, if any."""
+        if self.listen_conn is not None:
+            self.listen_conn.close()
+            self.listen_conn = None
+
+    def fetch_and_finalize(
+        self, cur: Cursor, prior_updates: dict[str, list], limit: int = BATCH_LIMIT
+    ) -> list[EventRow]:
+        """Commit the previous batch and fetch the next records to process.
+
+        The records are returned in an open transaction, which should stay open
+        while they are delivered. A crash during delivery rolls them back to
+        pending, so they are delivered again under the same idempotency key.
+        The next call, or `commit_batch`, writes their status updates and
+        commits.
+
+        All statements are sent in pipeline mode and synced once, so this costs
+        a single round-trip to Postgres. If the status updates got committed
+        but the fetch failed, `FetchError` is raised, so the caller knows not
+        to write them again.
+
+        The fetch statement is prepared on the server on first use, so later
+        batches skip its parse and planning.
+
+        The open cursor has `class_row(EventRow)` as row_factory. It should be
+        a binary cursor, so the columns are transferred in their native format.
+
+        Args:
+            prior_updates: The status updates of the previous batch, see `finalize`.
+            limit: The maximum amount of records to fetch.
+        """
+        in_transaction = _in_transaction(cur)
+        commit_cur = None
+        try:
+            with cur.connection.pipeline():
+                commit_cur = self._queue_commit(cur, prior_updates, in_transaction)
+                cur.execute("BEGIN", prepare=False)
+                cur.execute(self.fetch_sql, (limit,), prepare=True)
+        except psycopg.Error as e:
+            # The results of the statements after a failed one are discarded,
+            # so the COMMIT only has a result if it succeeded
+            if commit_cur is not None and commit_cur.statusmessage == "COMMIT":
+                raise FetchError(repr(e)) from e
+            raise
+        # Streaming the rows with `cur.stream()` would not let delivery start
+        # any earlier: it cannot run in pipeline mode, and Postgres only sends
+        # the rows of an UPDATE ... RETURNING once the whole update is done.
         return cur.fetchall()
 
-    def mark_skipped(self, cur: Cursor, event_id: int) -> int:
+    def commit_batch(self, cur: Cursor, updates: dict[str, list]) -> None:
+        """Write the status updates of a batch and commit its open transaction.
+
+        Used when no next batch is fetched right away, see `fetch_and_finalize`.
+
+        Args:
+            updates: The status updates of the batch, see `finalize`.
+        """
+        in_transaction = _in_transaction(cur)
+        with cur.connection.pipeline():
+            self._queue_commit(cur, updates, in_transaction)
+
+    def _queue_commit(
+        self, cur: Cursor, updates: dict[str, list], in_transaction: bool
+    ) -> Cursor | None:
+        """Queue the status updates and the commit of a batch in the pipeline.
+
+        Returns:
+            The cursor the COMMIT is executed on, or None if there is nothing
+            to commit.
+        """
+        if not in_transaction and not any(updates.values()):
+            return None
+        if not in_transaction:
+            cur.execute("BEGIN", prepare=False)
+        self.finalize(cur, updates)
+        return cur.connection.execute("COMMIT", prepare=False)
+
+    def finalize(self, cur: Cursor, updates: dict[str, list]) -> None:
+        """Write the status updates of a batch.
+
+        Args:
+            updates: The rows passed to the method of every status, keyed by
+                status: "skipped", "sent", "retry" and "dead" are passed to the
+                matching `flush_*` method, "pending" to `mark_pending`.
+        """
+        self.flush_skipped(cur, updates.get("skipped", []))
+        self.flush_sent(cur, updates.get("sent", []))
+        self.flush_retry(cur, updates.get("retry", []))
+        self.flush_dead(cur, updates.get("dead", []))
+        for event_id in updates.get("pending", []):
+            self.mark_pending(cur, event_id)
+
+    def mark_pending(self, cur: Cursor, event_id: int) -> int:
         cur.execute(
-            """
-            UPDATE webhook_events
-               SET status='skipped'
-             WHERE id=%s
-            """,
+            "UPDATE webhook_events SET status='pending' WHERE id=%s",
             (event_id,),
+            prepare=True,
         )
         return cur.rowcount
 
-    def mark_sent(self, cur: Cursor, event_id: int, svix_id: str):
+    def flush_skipped(self, cur: Cursor, rows: list[int]) -> None:
+        """Mark the given events as skipped in a single statement.
+
+        Args:
+            rows: The IDs of the events.
+        """
+        if not rows:
+            return
         cur.execute(
-            "UPDATE webhook_events SET status='sent', sent_at=now(), error=NULL, svix_id=%s WHERE id=%s",
-            (
-                svix_id,
-                event_id,
-            ),
+            "UPDATE webhook_events SET status='skipped' WHERE id = ANY(%s)",
+            (rows,),
+            prepare=True,
         )
 
-    def mark_pending(self, cur: Cursor, event_id: int) -> int:
+    def flush_sent(self, cur: Cursor, rows: list[tuple[int, str]]) -> None:
+        """Mark the given events as sent in a single statement.
+
+        Args:
+            rows: (event_id, svix_id) tuples.
+        """
+        if not rows:
+            return
         cur.execute(
-            "UPDATE webhook_events SET status='pending' WHERE id=%s",
-            (event_id,),
+            """
+            UPDATE webhook_events w
+               SET status='sent', sent_at=now(), error=NULL, svix_id=v.svix_id
+              FROM unnest(%s::bigint[], %s::text[]) AS v(id, svix_id)
+             WHERE w.id=v.id
+            """,
+            _columns(rows),
+            prepare=True,
         )
-        return cur.rowcount
 
-    def mark_dead(self, cur: Cursor, event_id: int, attempts: int, err: str) -> int:
+    def flush_dead(self, cur: Cursor, rows: list[tuple[int, int, str]]) -> None:
+        """Mark the given events as dead in a single statement.
+
+        Args:
+            rows: (event_id, attempts, err) tuples. err is stored as is, it
+                should be truncated to `MAX_ERROR_LENGTH`.
+        """
+        if not rows:
+            return
         cur.execute(
             """
-            UPDATE webhook_events
-            SET status='dead', attempts=%s, error=left(%s, 1000)
-            WHERE id=%s
+            UPDATE webhook_events w
+               SET status='dead', attempts=v.attempts, error=v.error
+              FROM unnest(%s::bigint[], %s::int[], %s::text[]) AS v(id, attempts, error)
+             WHERE w.id=v.id
             """,
-            (attempts, err, event_id),
+            _columns(rows),
+            prepare=True,
         )
-        return cur.rowcount
 
-    def mark_retry(
-        self,
-        cur: Cursor,
-        event_id: int,
-        attempts: int,
-        err: str,
-        next_attempt_at: dt.datetime,
-    ) -> int:
-        if attempts >= MAX_ATTEMPTS:
-            return self.mark_dead(cur, event_id, attempts, err)
-        else:
-            cur.execute(
-                """
-                UPDATE webhook_events
-                SET status='pending',
-                    attempts=%s,
-                    next_attempt_at=%s,
-                    error=left(%s, 1000)
-                WHERE id=%s
-                """,
-                (attempts, next_attempt_at, err, event_id),
-            )
-            return cur.rowcount
+    def flush_retry(
+        self, cur: Cursor, rows: list[tuple[int, int, str, dt.datetime]]
+    ) -> None:
+        """Put the given events back to pending in a single statement.
+
+        Events which reached `MAX_ATTEMPTS` should be passed to `flush_dead`
+        instead.
+
+        Args:
+            rows: (event_id, attempts, err, next_attempt_at) tuples. err is
+                stored as is, it should be truncated to `MAX_ERROR_LENGTH`.
+        """
+        if not rows:
+            return
+        cur.execute(
+            """
+            UPDATE webhook_events w
+               SET status='pending',
+                   attempts=v.attempts,
+                   next_attempt_at=v.next_attempt_at,
+                   error=v.error
+              FROM unnest(%s::bigint[], %s::int[], %s::text[], %s::timestamptz[])
+                   AS v(id, attempts, error, next_attempt_at)
+             WHERE w.id=v.id
+            """,
+            _columns(rows),
+            prepare=True,
+        )
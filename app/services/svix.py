@@ -1,19 +1,29 @@
-from svix.api import Svix, SvixOptions, MessageCreateOptions
-from svix.models import MessageIn, MessageOut
+import asyncio
+
+from svix.api import SvixAsync, SvixOptions, MessageCreateOptions
+from svix.api.message import message_in_raw
+from svix.models import MessageOut
 
 from viaa.configuration import ConfigParser
 from viaa.observability import logging
 
+# Maximum amount of requests to Svix that are in flight at the same time.
+MAX_CONCURRENT_REQUESTS = 32
+
 
 class SvixClient:
     def __init__(self, auth_token: str, base_url: str):
         config_parser = ConfigParser()
         self.log = logging.get_logger(__name__, config=config_parser)
 
-        self.svix = Svix(auth_token, SvixOptions(server_url=base_url))
+        self.svix = SvixAsync(auth_token, SvixOptions(server_url=base_url))
+        # Every access of `self.svix.message` builds a new httpx client, keep a
+        # single one so its connections are reused. It is bound to the event
+        # loop it is first used in, so always post from the same loop.
+        self.message = self.svix.message
 
-    def post_event(
-        self, app_id: str, event_id: int, event_type: str, payload: dict[str, str]
+    async def post_event(
+        self, app_id: str, event_id: int, event_type: str, payload: str
     ) -> MessageOut:
         """Posts an event to svix
 
@@ -21,12 +31,41 @@ class SvixClient:
             app_id: The ID of the application in Svix to send the event to.
             event_id: The event ID hat will be used as idempotency key.
             event_type: The mandatory event_type.
-            payload: The actual payload of the event.
-        
+            payload: The actual payload of the event, as JSON text. It is
+                sent as is, without being parsed or minified.
+
         Returns:
             MessageOut: The response message from Svix.
         """
-        message = MessageIn(event_type=event_type, payload=payload)
-        return self.svix.message.create(
+        message = message_in_raw(event_type, payload)
+        return await self.message.create(
             app_id, message, MessageCreateOptions(idempotency_key=f"webhook_events:{event_id}")
         )
+
+    async def post_events_batch(
+        self, app_payloads: list[tuple[str, int, str, str]]
+    ) -> list[MessageOut | BaseException]:
+        """Posts a batch of events to svix concurrently.
+
+        At most `MAX_CONCURRENT_REQUESTS` requests are in flight at the same time.
+
+        Args:
+            app_payloads: A list of (app_id, event_id, event_type, payload) tuples.
+                See `post_event` for the meaning of each field.
+
+        Returns:
+            A list with, in the same order as `app_payloads`, either the response
+            message from Svix or the exception raised while posting the event.
+        """
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+        async def post(
+            app_id: str, event_id: int, event_type: str, payload: str
+        ) -> MessageOut:
+            async with semaphore:
+                return await self.post_event(app_id, event_id, event_type, payload)
+
+        return await asyncio.gather(
+            *(post(*app_payload) for app_payload in app_payloads),
+            return_exceptions=True,
+        )
@@ -1,4 +1,290 @@
+import asyncio
+import datetime as dt
+from unittest.mock import ANY, AsyncMock, MagicMock
+
+import psycopg
 import pytest
+from psycopg_pool import PoolTimeout
+from svix.exceptions import HttpError, HTTPValidationError
+
+from app import app as app_module
+from app.app import (
+    BACKOFF_CAP_S,
+    BATCH_LIMIT_MAX,
+    BATCH_LIMIT_MIN,
+    MAX_WRITE_ATTEMPTS,
+    PgEventsPoller,
+)
+from app.services.db import (
+    BATCH_LIMIT,
+    MAX_ATTEMPTS,
+    MAX_ERROR_LENGTH,
+    EventRow,
+    FetchError,
+)
+
 
 def test_sanity_check():
-    assert True
\ No newline at end of file
+    assert True
+
+
+@pytest.fixture
+def poller(monkeypatch):
+    config_parser = MagicMock()
+    config_parser.app_cfg = {
+        "db": {
+            "host": "localhost",
+            "port": 5432,
+            "dbname": "db",
+            "username": "user",
+            "password": "password",
+        },
+        "svix": {
+            "auth_token": "token",
+            "base_url": "http://localhost",
+            "bucket_application_map": '{"bucket-a": "app_123"}',
+        },
+    }
+    monkeypatch.setattr(app_module, "ConfigParser", MagicMock(return_value=config_parser))
+    monkeypatch.setattr(app_module, "logging", MagicMock())
+    monkeypatch.setattr(app_module, "DbClient", MagicMock())
+    monkeypatch.setattr(app_module, "SvixClient", MagicMock())
+
+    poller = PgEventsPoller()
+    yield poller
+    poller._runner.close()
+
+
+def make_row(attempts: int = 0) -> EventRow:
+    return EventRow(1, "event.type", "{}", attempts, "bucket-a")
+
+
+def queued(poller: PgEventsPoller) -> dict[str, list]:
+    return {status: rows for status, rows in poller._updates.items() if rows}
+
+
+def test_handle_sent(poller):
+    result = MagicMock(id="msg_123")
+
+    poller._handle_webhook_event(make_row(), result)
+
+    assert queued(poller) == {"sent": [(1, "msg_123")]}
+
+
+def test_handle_validation_error(poller):
+    e = HTTPValidationError.init_exception({}, 422)
+
+    poller._handle_webhook_event(make_row(attempts=2), e)
+
+    assert queued(poller) == {"dead": [(1, 3, repr(e))]}
+    assert poller.should_continue
+
+
+def test_handle_unauthorized(poller):
+    poller._handle_webhook_event(make_row(), HttpError.init_exception({}, 401))
+
+    assert queued(poller) == {"pending": [1]}
+    assert not poller.should_continue
+
+
+@pytest.mark.parametrize(
+    "e",
+    [
+        HttpError.init_exception({}, 500),
+        asyncio.CancelledError(),
+        KeyboardInterrupt(),
+        BaseException(),
+    ],
+)
+def test_handle_retry(poller, e):
+    poller._handle_webhook_event(make_row(attempts=2), e)
+
+    [(row_id, attempts, err, _)] = poller._updates["retry"]
+    assert (row_id, attempts, err) == (1, 3, repr(e))
+    assert list(queued(poller)) == ["retry"]
+    assert poller.should_continue
+
+
+@pytest.mark.parametrize(
+    "e", [HttpError.init_exception({}, 500), asyncio.CancelledError()]
+)
+def test_handle_max_attempts(poller, e):
+    poller._handle_webhook_event(make_row(attempts=MAX_ATTEMPTS - 1), e)
+
+    assert queued(poller) == {"dead": [(1, MAX_ATTEMPTS, repr(e))]}
+
+
+@pytest.mark.parametrize(
+    "e, status",
+    [
+        (
+            HTTPValidationError.init_exception(
+                {"detail": [{"loc": ["payload"], "msg": "x" * 5000, "type": "value"}]},
+                422,
+            ),
+            "dead",
+        ),
+        (HttpError.init_exception({"detail": "x" * 5000}, 500), "retry"),
+        (ValueError("x" * 5000), "retry"),
+    ],
+)
+def test_error_truncated(poller, e, status):
+    poller._handle_webhook_event(make_row(), e)
+
+    [update] = poller._updates[status]
+    assert update[2] == repr(e)[:MAX_ERROR_LENGTH]
+    assert len(update[2]) == MAX_ERROR_LENGTH
+
+
+def test_retry_relative_to_batch(poller):
+    rows = [make_row(), make_row()._replace(id=2)]
+    errors = [HttpError.init_exception({}, 500), HttpError.init_exception({}, 503)]
+    poller.svix_client.post_events_batch = AsyncMock(return_value=errors)
+    poller._backoff_seconds = MagicMock(return_value=8)
+    before = dt.datetime.now(dt.UTC)
+
+    poller._handle_batch(rows)
+
+    assert before <= poller._batch_now <= dt.datetime.now(dt.UTC)
+    next_at = poller._batch_now + dt.timedelta(seconds=8)
+    assert [retry[3] for retry in poller._updates["retry"]] == [next_at, next_at]
+
+
+def test_batch_limit_doubles(poller):
+    poller._adapt_batch_limit(BATCH_LIMIT, 0.1, 0)
+
+    assert poller._batch_limit == BATCH_LIMIT * 2
+
+
+def test_batch_limit_max(poller):
+    poller._batch_limit = BATCH_LIMIT_MAX - 1
+
+    poller._adapt_batch_limit(BATCH_LIMIT_MAX - 1, 0.1, 0)
+
+    assert poller._batch_limit == BATCH_LIMIT_MAX
+
+
+@pytest.mark.parametrize(
+    "row_count, elapsed",
+    [
+        # Not a full batch
+        (BATCH_LIMIT - 1, 0.1),
+        # Too slow
+        (BATCH_LIMIT, 9.0),
+    ],
+)
+def test_batch_limit_unchanged(poller, row_count, elapsed):
+    poller._adapt_batch_limit(row_count, elapsed, 0)
+
+    assert poller._batch_limit == BATCH_LIMIT
+
+
+def test_batch_limit_halves(poller):
+    poller._adapt_batch_limit(BATCH_LIMIT, 0.1, BATCH_LIMIT // 2)
+
+    assert poller._batch_limit == BATCH_LIMIT // 2
+
+
+def test_batch_limit_min(poller):
+    poller._batch_limit = BATCH_LIMIT_MIN + 1
+
+    poller._adapt_batch_limit(BATCH_LIMIT_MIN + 1, 0.1, BATCH_LIMIT_MIN + 1)
+
+    assert poller._batch_limit == BATCH_LIMIT_MIN
+
+
+@pytest.mark.parametrize(
+    "attempts, upper",
+    [(-1, 1), (0, 1), (1, 2), (5, 32), (10, BACKOFF_CAP_S), (50, BACKOFF_CAP_S)],
+)
+def test_backoff_range(poller, attempts, upper):
+    backoffs = {poller._backoff_seconds(attempts) for _ in range(200)}
+
+    assert min(backoffs) >= 1
+    assert max(backoffs) <= upper
+
+
+@pytest.fixture
+def polling(poller, monkeypatch):
+    """Run `start_polling` without signal handlers and pauses."""
+    monkeypatch.setattr(app_module.signal, "signal", MagicMock())
+    monkeypatch.setattr(app_module.time, "sleep", MagicMock())
+    return poller
+
+
+def test_updates_kept_after_failed_write(polling):
+    db_client = polling.db_client
+    polling._updates["sent"].append((1, "msg_1"))
+    written = []
+
+    def fetch_and_finalize(cur, updates, limit):
+        written.append(updates["sent"])
+        if len(written) == 1:
+            raise psycopg.OperationalError("connection lost")
+        polling.stop()
+        return []
+
+    db_client.fetch_and_finalize.side_effect = fetch_and_finalize
+
+    polling.start_polling()
+
+    assert written == [[(1, "msg_1")], [(1, "msg_1")]]
+    db_client.commit_batch.assert_called()
+    assert not any(polling._updates.values())
+
+
+def test_updates_dropped_after_max_write_attempts(polling):
+    db_client = polling.db_client
+    polling._updates["sent"].append((1, "msg_1"))
+    written = []
+
+    def fetch_and_finalize(cur, updates, limit):
+        written.append(updates["sent"])
+        if len(written) > MAX_WRITE_ATTEMPTS:
+            polling.stop()
+            return []
+        raise psycopg.OperationalError("connection lost")
+
+    db_client.fetch_and_finalize.side_effect = fetch_and_finalize
+    db_client.commit_batch.side_effect = psycopg.OperationalError("connection lost")
+
+    polling.start_polling()
+
+    assert written == [[(1, "msg_1")]] * MAX_WRITE_ATTEMPTS + [[]]
+    # Written one status at a time before dropping them
+    db_client.commit_batch.assert_any_call(ANY, {"sent": [(1, "msg_1")]})
+
+
+def test_updates_dropped_after_failed_fetch(polling):
+    db_client = polling.db_client
+    polling._updates["sent"].append((1, "msg_1"))
+    polling._failed_writes = 1
+    db_client.fetch_and_finalize.side_effect = FetchError("division by zero")
+
+    with pytest.raises(FetchError):
+        polling._fetch(MagicMock())
+
+    assert not any(polling._updates.values())
+    assert polling._failed_writes == 0
+
+
+def test_updates_kept_without_connection(polling):
+    db_client = polling.db_client
+    polling._updates["sent"].append((1, "msg_1"))
+    timeouts = MAX_WRITE_ATTEMPTS + 1
+
+    def connection():
+        nonlocal timeouts
+        timeouts -= 1
+        if timeouts == 0:
+            polling.stop()
+        raise PoolTimeout("couldn't get a connection")
+
+    db_client.pool.connection.side_effect = connection
+    polling._write_updates_separately = MagicMock()
+
+    polling.start_polling()
+
+    assert polling._updates["sent"] == [(1, "msg_1")]
+    # Only once the poller stops
+    polling._write_updates_separately.assert_called_once_with()
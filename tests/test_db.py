@@ -0,0 +1,193 @@
+import datetime as dt
+from unittest.mock import MagicMock
+
+import psycopg
+import pytest
+from psycopg.pq import TransactionStatus
+
+from app.services import db as db_module
+from app.services.db import DbClient, FetchError, _columns
+
+FINALIZE_METHODS = (
+    "flush_skipped",
+    "flush_sent",
+    "flush_retry",
+    "flush_dead",
+    "mark_pending",
+)
+NOW = dt.datetime.now(dt.UTC)
+
+
+@pytest.fixture
+def db_client(monkeypatch):
+    monkeypatch.setattr(db_module, "ConfigParser", MagicMock())
+    monkeypatch.setattr(db_module, "logging", MagicMock())
+    monkeypatch.setattr(db_module, "ConnectionPool", MagicMock())
+
+    return DbClient("localhost", 5432, "db", "user", "password")
+
+
+@pytest.fixture
+def calls(db_client):
+    """Record the statements sent on a mock cursor, and the `finalize` methods
+    called in between, in order.
+    """
+    recorder = MagicMock()
+    for name in FINALIZE_METHODS:
+        setattr(db_client, name, getattr(recorder, name))
+
+    def statements() -> list[str]:
+        names = []
+        for name, args, _ in recorder.mock_calls:
+            if name in ("cur.execute", "cur.connection.execute"):
+                names.append("FETCH" if args[0] == db_client.fetch_sql else args[0])
+            elif name in FINALIZE_METHODS:
+                names.append(name)
+        return names
+
+    recorder.statements = statements
+    return recorder
+
+
+def updates() -> dict[str, list]:
+    return {
+        "skipped": [1],
+        "sent": [(2, "msg_2")],
+        "retry": [],
+        "dead": [],
+        "pending": [3],
+    }
+
+
+def test_fetch_and_finalize_in_transaction(db_client, calls):
+    cur = calls.cur
+    cur.connection.info.transaction_status = TransactionStatus.INTRANS
+
+    db_client.fetch_and_finalize(cur, updates(), 10)
+
+    assert calls.statements() == [
+        *FINALIZE_METHODS,
+        "COMMIT",
+        "BEGIN",
+        "FETCH",
+    ]
+
+
+def test_fetch_and_finalize_idle(db_client, calls):
+    cur = calls.cur
+    cur.connection.info.transaction_status = TransactionStatus.IDLE
+
+    db_client.fetch_and_finalize(cur, updates(), 10)
+
+    assert calls.statements() == [
+        "BEGIN",
+        *FINALIZE_METHODS,
+        "COMMIT",
+        "BEGIN",
+        "FETCH",
+    ]
+
+
+def test_fetch_and_finalize_nothing_to_commit(db_client, calls):
+    cur = calls.cur
+    cur.connection.info.transaction_status = TransactionStatus.IDLE
+
+    db_client.fetch_and_finalize(cur, {}, 10)
+
+    assert calls.statements() == ["BEGIN", "FETCH"]
+
+
+def test_commit_batch(db_client, calls):
+    cur = calls.cur
+    cur.connection.info.transaction_status = TransactionStatus.INTRANS
+
+    db_client.commit_batch(cur, updates())
+
+    assert calls.statements() == [*FINALIZE_METHODS, "COMMIT"]
+
+
+@pytest.mark.parametrize(
+    "commit_status, raised",
+    [
+        # Only the fetch failed
+        ("COMMIT", FetchError),
+        # The COMMIT was never executed
+        (None, psycopg.OperationalError),
+    ],
+)
+def test_fetch_and_finalize_failed(db_client, calls, commit_status, raised):
+    cur = calls.cur
+    cur.connection.info.transaction_status = TransactionStatus.INTRANS
+    cur.connection.execute.return_value.statusmessage = commit_status
+    cur.connection.pipeline.return_value.__exit__.side_effect = (
+        psycopg.OperationalError("server closed the connection")
+    )
+
+    with pytest.raises(raised):
+        db_client.fetch_and_finalize(cur, updates(), 10)
+
+
+def test_finalize_one_statement_per_status(db_client):
+    cur = MagicMock()
+
+    db_client.finalize(
+        cur,
+        {
+            "skipped": [1, 2],
+            "sent": [(3, "msg_3"), (4, "msg_4")],
+            "retry": [(5, 1, "error", NOW), (6, 2, "error", NOW)],
+            "dead": [(7, 20, "error"), (8, 20, "error")],
+            "pending": [],
+        },
+    )
+
+    assert cur.execute.call_count == 4
+
+
+@pytest.mark.parametrize(
+    "method", ["flush_skipped", "flush_sent", "flush_retry", "flush_dead"]
+)
+def test_flush_nothing(db_client, method):
+    cur = MagicMock()
+
+    getattr(db_client, method)(cur, [])
+
+    cur.execute.assert_not_called()
+
+
+def test_columns():
+    assert _columns([(1, "msg_1", 3), (2, "msg_2", 4)]) == [
+        [1, 2],
+        ["msg_1", "msg_2"],
+        [3, 4],
+    ]
+    assert _columns([]) == []
+
+
+def test_flush_skipped(db_client):
+    cur = MagicMock()
+
+    db_client.flush_skipped(cur, [1, 2])
+
+    query, params = cur.execute.call_args.args
+    assert "ANY(%s)" in query
+    assert params == ([1, 2],)
+
+
+@pytest.mark.parametrize(
+    "method, rows",
+    [
+        ("flush_sent", [(1, "msg_1"), (2, "msg_2")]),
+        ("flush_retry", [(1, 1, "error", NOW), (2, 5, "error", NOW)]),
+        ("flush_dead", [(1, 20, "error"), (2, 20, "error")]),
+    ],
+)
+def test_flush_as_arrays(db_client, method, rows):
+    cur = MagicMock()
+
+    getattr(db_client, method)(cur, rows)
+
+    query, params = cur.execute.call_args.args
+    # One array per column, unnested in the same order
+    assert query.count("[]") == len(rows[0])
+    assert params == [list(column) for column in zip(*rows)]
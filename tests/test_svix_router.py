@@ -0,0 +1,25 @@
+import pytest
+
+from app.helpers.svix_router import SvixRouter
+
+
+def test_route():
+    router = SvixRouter('{"bucket-a": "app_123", "bucket-b": "app_456"}')
+
+    assert router.route("bucket-a") == "app_123"
+    assert router.route("bucket-b") == "app_456"
+    assert router.route("bucket-c") is None
+
+
+@pytest.mark.parametrize(
+    "mapping",
+    [
+        "not json",
+        '["bucket-a", "app_123"]',
+        '{"bucket-a": ""}',
+        '{"bucket-a": 123}',
+    ],
+)
+def test_invalid_mapping(mapping):
+    with pytest.raises(ValueError):
+        SvixRouter(mapping)